@@ -1,6 +1,6 @@
 """
 Script Name: Automation_PrepareLasData_AP_1.0.py
-Description: Perform voxel downsampling on point clouds and labels, convert .pcd and .labels to .las format
+Description: Perform voxel downsampling (or fixed-count random, class balanced or approximate farthest point sampling) on point clouds and labels, convert .pcd and .labels to .las format
 Created Date: 2024-04-17
 Author: Aleksandar Lukic, Ana Petrovic
 Version: 1.0
@@ -16,6 +16,9 @@ Downsampling is performed by dividing a point cloud into smaller voxel grids
 and then extracting a representative point (typically average point) 
 from each grid to reduce the point cloud's density.
 
+Sampling mode other than "voxel" ignores voxel size and returns exactly num_points points
+(clouds smaller than num_points are padded with repeated points), which keeps training batches even.
+
 ***Expected folder structure***:
 .
 ├──Automation_PrepareLasData_AP_1.0.py
@@ -123,7 +126,227 @@ def convert_pcd_to_las_with_classifications(pcd_file, las_file_path, classificat
     # Write LAS file to disk
     las.write(las_file_path)
 
-def down_sample( dense_pcd_path, dense_label_path, sparse_pcd_path, sparse_label_path, voxel_size):
+# Number of points processed at once by filtering and sampling, keeps memory flat on 100M-point clouds
+CHUNK_SIZE = 10_000_000
+
+# Sampling modes with fixed point count, "voxel" keeps the voxel grid path
+SAMPLING_MODES = ("voxel", "random", "class_balanced", "fps")
+
+# Pack non-negative voxel coordinates (N x 3) into one int64 key per point, 21 bits per axis
+def pack_voxel_ids(voxel_ids):
+    if voxel_ids.max() >= 1 << 21:
+        raise ValueError("Voxel grid spans more than 2^21 voxels per axis, increase voxel size")
+    return (voxel_ids[:, 0] << 42) | (voxel_ids[:, 1] << 21) | voxel_ids[:, 2]
+
+# Filter points, colors and labels in one pass and return compacted arrays.
+# class_table maps label to new label (-1 drops the class), unlisted labels are kept only if keep_unlisted is set.
+# crop_bounds is (min_xyz, max_xyz). Points in voxels of outlier_voxel_size holding fewer
+# than outlier_min_points points are dropped as outliers. Kept rows are moved to the front
+# of the input arrays chunk by chunk, so no full-size copies of points, colors or labels are made.
+def filter_points(points, colors, labels, class_table=None, keep_unlisted=True, crop_bounds=None, outlier_voxel_size=None, outlier_min_points=2):
+    num_total = points.shape[0]
+    keep = np.ones(num_total, dtype=bool)
+
+    # Labels index the lookup table below, negative labels would wrap around to other classes
+    if labels is not None and num_total:
+        min_label = min(int(labels[start:start + CHUNK_SIZE].min()) for start in range(0, num_total, CHUNK_SIZE))
+        if min_label < 0:
+            raise ValueError("Labels must be non-negative, found label {}".format(min_label))
+
+    # Lookup table for class include/exclude/remap, negative value drops the class
+    lut = None
+    if labels is not None and class_table:
+        size = max(int(labels.max()) if num_total else 0, max(class_table)) + 1
+        lut = np.arange(size, dtype=np.int64) if keep_unlisted else np.full(size, -1, dtype=np.int64)
+        for label, new_label in class_table.items():
+            lut[label] = new_label
+
+    # Class and bounding box filters, chunk by chunk
+    for start in range(0, num_total, CHUNK_SIZE):
+        chunk_keep = keep[start:start + CHUNK_SIZE]
+        if lut is not None:
+            chunk_keep &= lut[labels[start:start + CHUNK_SIZE]] >= 0
+        if crop_bounds is not None:
+            chunk_points = points[start:start + CHUNK_SIZE]
+            chunk_keep &= np.all((chunk_points >= crop_bounds[0]) & (chunk_points <= crop_bounds[1]), axis=1)
+
+    # Outlier removal, drop points in sparsely occupied voxels
+    num_kept = int(keep.sum())
+    if outlier_voxel_size is not None and num_kept:
+
+        # Voxel grid origin of kept points, chunk by chunk
+        min_ids = None
+        for start in range(0, num_total, CHUNK_SIZE):
+            chunk_points = points[start:start + CHUNK_SIZE][keep[start:start + CHUNK_SIZE]]
+            if chunk_points.shape[0]:
+                chunk_min = np.floor(chunk_points.min(axis=0) / outlier_voxel_size).astype(np.int64)
+                min_ids = chunk_min if min_ids is None else np.minimum(min_ids, chunk_min)
+
+        # One packed int64 voxel key per kept point, filled chunk by chunk
+        keys = np.empty(num_kept, dtype=np.int64)
+        write = 0
+        for start in range(0, num_total, CHUNK_SIZE):
+            chunk_points = points[start:start + CHUNK_SIZE][keep[start:start + CHUNK_SIZE]]
+            if chunk_points.shape[0]:
+                voxel_ids = np.floor(chunk_points / outlier_voxel_size).astype(np.int64) - min_ids
+                keys[write:write + chunk_points.shape[0]] = pack_voxel_ids(voxel_ids)
+                write += chunk_points.shape[0]
+        del chunk_points
+        _, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        del keys
+
+        # Keep points whose voxel holds enough points, chunk by chunk
+        read = 0
+        for start in range(0, num_total, CHUNK_SIZE):
+            chunk_keep = keep[start:start + CHUNK_SIZE]
+            count = int(chunk_keep.sum())
+            chunk_keep[chunk_keep] = counts[inverse[read:read + count]] >= outlier_min_points
+            read += count
+        del inverse, counts
+
+    # Compact kept rows to the front, write position never passes read position
+    write = 0
+    for start in range(0, num_total, CHUNK_SIZE):
+        chunk_keep = keep[start:start + CHUNK_SIZE]
+        count = int(chunk_keep.sum())
+        points[write:write + count] = points[start:start + CHUNK_SIZE][chunk_keep]
+        if colors is not None:
+            colors[write:write + count] = colors[start:start + CHUNK_SIZE][chunk_keep]
+        if labels is not None:
+            chunk_labels = labels[start:start + CHUNK_SIZE][chunk_keep]
+            labels[write:write + count] = lut[chunk_labels] if lut is not None else chunk_labels
+        write += count
+
+    return points[:write], colors[:write] if colors is not None else None, labels[:write] if labels is not None else None
+
+# Randomly pick num_points indices out of num_total, chunk by chunk
+def random_sample_indices(num_total, num_points, rng):
+    if num_total == 0:
+        raise ValueError("Cannot sample from an empty point cloud")
+
+    # Not enough points, keep all of them and pad with repeated points to reach exact count
+    if num_total <= num_points:
+        padding = rng.integers(0, num_total, size=num_points - num_total)
+        return np.concatenate([np.arange(num_total), padding])
+
+    # Split the target count across chunks proportionally to chunk sizes (sampling without replacement)
+    chunk_sizes = [min(CHUNK_SIZE, num_total - start) for start in range(0, num_total, CHUNK_SIZE)]
+    chunk_counts = rng.multivariate_hypergeometric(chunk_sizes, num_points)
+
+    # Sample inside each chunk
+    indices = []
+    for start, chunk_size, chunk_count in zip(range(0, num_total, CHUNK_SIZE), chunk_sizes, chunk_counts):
+        indices.append(start + rng.choice(chunk_size, size=chunk_count, replace=False))
+
+    return np.sort(np.concatenate(indices))
+
+# Pick num_points indices so that every class is represented as equally as possible
+def class_balanced_sample_indices(labels, num_points, rng):
+    if labels.shape[0] == 0:
+        raise ValueError("Cannot sample from an empty point cloud")
+
+    # Count points per class in every chunk
+    num_classes = int(labels.max()) + 1
+    chunk_starts = range(0, labels.shape[0], CHUNK_SIZE)
+    chunk_class_counts = np.stack([np.bincount(labels[start:start + CHUNK_SIZE], minlength=num_classes) for start in chunk_starts])
+    class_counts = chunk_class_counts.sum(axis=0)
+    present_classes = np.flatnonzero(class_counts)
+
+    # Give every class an equal share, going from the smallest class to the largest,
+    # so classes with too few points pass their leftover to the bigger ones
+    class_targets = np.zeros(num_classes, dtype=np.int64)
+    remaining_points = num_points
+    sorted_classes = present_classes[np.argsort(class_counts[present_classes], kind="stable")]
+    for i, c in enumerate(sorted_classes):
+        share = remaining_points // (sorted_classes.shape[0] - i)
+        class_targets[c] = min(class_counts[c], share)
+        remaining_points -= class_targets[c]
+
+    # Split every class target across chunks proportionally to the class count in each chunk
+    chunk_class_targets = np.zeros_like(chunk_class_counts)
+    for c in present_classes:
+        chunk_class_targets[:, c] = rng.multivariate_hypergeometric(chunk_class_counts[:, c], class_targets[c])
+
+    # Sample inside each chunk, only the picked indices are kept
+    indices = []
+    for chunk_index, start in enumerate(chunk_starts):
+        chunk = labels[start:start + CHUNK_SIZE]
+        for c in np.flatnonzero(chunk_class_targets[chunk_index]):
+            candidates = np.flatnonzero(chunk == c)
+            indices.append(start + rng.choice(candidates, size=chunk_class_targets[chunk_index, c], replace=False))
+    indices = np.sort(np.concatenate(indices))
+
+    # Pad with repeated points if the whole cloud is smaller than num_points
+    if indices.shape[0] < num_points:
+        indices = np.concatenate([indices, rng.choice(indices, size=num_points - indices.shape[0])])
+
+    return indices
+
+# Return index of the first point in every occupied voxel of the given size, chunk by chunk
+def voxel_representatives(points, min_bound, size):
+    keys = []
+    first = []
+    for start in range(0, points.shape[0], CHUNK_SIZE):
+        voxel_ids = np.floor((points[start:start + CHUNK_SIZE] - min_bound) / size).astype(np.int64)
+        chunk_keys, chunk_first = np.unique(pack_voxel_ids(voxel_ids), return_index=True)
+        keys.append(chunk_keys)
+        first.append(start + chunk_first)
+
+    # Voxels shared by several chunks keep the point of the earliest chunk
+    _, merged = np.unique(np.concatenate(keys), return_index=True)
+    return np.concatenate(first)[merged]
+
+# Approximate farthest point sampling: keep one point per occupied voxel of the full cloud,
+# with the voxel size chosen so that the number of occupied voxels just reaches num_points.
+# Sparse regions get as many picks as their occupied voxels, not as their share of points
+def farthest_point_sample_indices(points, num_points, rng, iterations=20, tolerance=1.25):
+    if points.shape[0] <= num_points:
+        return random_sample_indices(points.shape[0], num_points, rng)
+
+    # Bounds of the cloud, chunk by chunk
+    min_bound = np.min([points[start:start + CHUNK_SIZE].min(axis=0) for start in range(0, points.shape[0], CHUNK_SIZE)], axis=0)
+    max_bound = np.max([points[start:start + CHUNK_SIZE].max(axis=0) for start in range(0, points.shape[0], CHUNK_SIZE)], axis=0)
+    extent = float((max_bound - min_bound).max()) or 1.0
+
+    # Bisection in log space between the finest size that still fits 21 bit voxel keys and the whole extent,
+    # looking for the largest voxel size that still gives at least num_points occupied voxels
+    low, high = extent / (1 << 20), extent
+    best = None
+    for _ in range(iterations):
+        if best is not None and best.shape[0] <= num_points * tolerance:
+            break
+        size = np.sqrt(low * high)
+        representatives = voxel_representatives(points, min_bound, size)
+        if representatives.shape[0] >= num_points:
+            best = representatives
+            low = size
+        else:
+            high = size
+
+    # Duplicated points can leave fewer occupied voxels than num_points even at the finest size, fill up randomly
+    if best is None:
+        best = voxel_representatives(points, min_bound, low)
+    if best.shape[0] < num_points:
+        return np.sort(np.concatenate([best, random_sample_indices(points.shape[0], num_points - best.shape[0], rng)]))
+
+    # Trim to the exact count
+    return np.sort(rng.choice(best, size=num_points, replace=False))
+
+# Return indices of num_points points picked with the given sampling mode (random, class_balanced, fps)
+def sample_indices(points, labels, num_points, sampling_mode, rng):
+    if sampling_mode == "random":
+        return random_sample_indices(points.shape[0], num_points, rng)
+    if sampling_mode == "class_balanced":
+        if labels is None:
+            print("No labels found, falling back to random sampling")
+            return random_sample_indices(points.shape[0], num_points, rng)
+        return class_balanced_sample_indices(labels, num_points, rng)
+    if sampling_mode == "fps":
+        return farthest_point_sample_indices(points, num_points, rng)
+    raise ValueError("Unknown sampling mode: {}".format(sampling_mode))
+
+def down_sample( dense_pcd_path, dense_label_path, sparse_pcd_path, sparse_label_path, voxel_size, sampling_mode="voxel", num_points=None, seed=None,
+                 class_table=None, keep_unlisted=True, crop_bounds=None, outlier_voxel_size=None, outlier_min_points=2):
 
     # Skip if done
     if os.path.isfile(sparse_pcd_path) and ( not os.path.isfile(dense_label_path) or os.path.isfile(sparse_label_path)):
@@ -132,6 +355,16 @@ def down_sample( dense_pcd_path, dense_label_path, sparse_pcd_path, sparse_label
     else:
         print("Processing:", file_prefix)
 
+    # Fixed-count sampling needs a positive target point count
+    if sampling_mode not in SAMPLING_MODES:
+        raise ValueError("Unknown sampling mode: {}, expected one of {}".format(sampling_mode, SAMPLING_MODES))
+    if sampling_mode != "voxel" and (not isinstance(num_points, (int, np.integer)) or isinstance(num_points, bool) or num_points <= 0):
+        raise ValueError("num_points must be a positive int for sampling mode {}, got {!r}".format(sampling_mode, num_points))
+
+    # By default skip label 0, pass empty class table to keep every class
+    if class_table is None:
+        class_table = {0: -1}
+
     # Inputs
     dense_pcd = open3d.io.read_point_cloud(dense_pcd_path)
     try:
@@ -139,28 +372,54 @@ def down_sample( dense_pcd_path, dense_label_path, sparse_pcd_path, sparse_label
     except:
         dense_labels = None
 
-    # Skip label 0, we use explicit frees to reduce memory usage
-    print("Num points:", np.asarray(dense_pcd.points).shape[0])
-    if dense_labels is not None:
-        non_zero_indexes = dense_labels != 0
+    # Read points, colors and labels as plain arrays (views of Open3D buffers, no copies)
+    dense_points = np.asarray(dense_pcd.points)
+    dense_colors = np.asarray(dense_pcd.colors) if dense_pcd.has_colors() else None
+    print("Num points:", dense_points.shape[0])
 
-        dense_points = np.asarray(dense_pcd.points)[non_zero_indexes]
-        dense_pcd.points = open3d.utility.Vector3dVector()
-        dense_pcd.points = open3d.utility.Vector3dVector(dense_points)
-        del dense_points
+    # Drop/remap classes, crop and remove outliers in one pass, arrays are compacted in place
+    dense_points, dense_colors, dense_labels = filter_points(dense_points, dense_colors, dense_labels, class_table, keep_unlisted, crop_bounds, outlier_voxel_size, outlier_min_points)
+    print("Num points after filtering:", dense_points.shape[0])
 
-        dense_colors = np.asarray(dense_pcd.colors)[non_zero_indexes]
-        dense_pcd.colors = open3d.utility.Vector3dVector()
-        dense_pcd.colors = open3d.utility.Vector3dVector(dense_colors)
-        del dense_colors
+    # Nothing left to downsample, e.g. scan with only class 0 or crop box outside the cloud
+    if dense_points.shape[0] == 0:
+        print("No points left after filtering, skipped:", file_prefix)
+        return
 
-        dense_labels = dense_labels[non_zero_indexes]
-        print("Num points after 0-skip:", np.asarray(dense_pcd.points).shape[0])
+    # Sample a fixed number of points, colors and labels are picked with the same indices
+    if sampling_mode != "voxel":
+        rng = np.random.default_rng(seed)
+        indices = sample_indices(dense_points, dense_labels, num_points, sampling_mode, rng)
 
-    # Downsample points
-    min_bound = dense_pcd.get_min_bound() - voxel_size * 0.5
-    max_bound = dense_pcd.get_max_bound() + voxel_size * 0.5
+        sparse_pcd = open3d.geometry.PointCloud()
+        sparse_pcd.points = open3d.utility.Vector3dVector(dense_points[indices])
+        if dense_colors is not None:
+            sparse_pcd.colors = open3d.utility.Vector3dVector(dense_colors[indices])
+        del dense_points, dense_colors, dense_pcd
 
+        open3d.io.write_point_cloud(filename = sparse_pcd_path, pointcloud = sparse_pcd, format='auto', write_ascii=False, compressed=False, print_progress=False)
+        print("Point cloud written to:", sparse_pcd_path, "(", sampling_mode, num_points, "points )")
+
+        if dense_labels is not None:
+            write_labels(sparse_label_path, dense_labels[indices])
+            print("Labels written to:", sparse_label_path)
+        return
+
+    # Hand compact arrays to the voxelizer. Original points are freed before colors are copied,
+    # views must be deleted before their Open3D buffers are released
+    min_bound = dense_points.min(axis=0) - voxel_size * 0.5
+    max_bound = dense_points.max(axis=0) + voxel_size * 0.5
+    compact_pcd = open3d.geometry.PointCloud()
+    compact_pcd.points = open3d.utility.Vector3dVector(dense_points)
+    del dense_points
+    dense_pcd.points = open3d.utility.Vector3dVector()
+    if dense_colors is not None:
+        compact_pcd.colors = open3d.utility.Vector3dVector(dense_colors)
+        del dense_colors
+        dense_pcd.colors = open3d.utility.Vector3dVector()
+    dense_pcd = compact_pcd
+
+    # Downsample points
     sparse_pcd, cubics_ids, something = open3d.geometry.PointCloud.voxel_down_sample_and_trace( dense_pcd, voxel_size, min_bound, max_bound, approximate_class=False)
     
     print('Type od sparse_pcd ', type(sparse_pcd))
@@ -200,6 +459,20 @@ def down_sample( dense_pcd_path, dense_label_path, sparse_pcd_path, sparse_label
 if __name__ == "__main__":
     voxel_size = 0.05
 
+    # Sampling mode: "voxel" (voxel grid, point count varies), or fixed point count with
+    # "random", "class_balanced" (equal share per label) or "fps" (approximate farthest point sampling)
+    sampling_mode = "voxel"
+    num_points = 65536
+    seed = 0
+
+    # Preprocessing before downsampling: class table maps label to new label (-1 drops class),
+    # optional crop box ((min_x, min_y, min_z), (max_x, max_y, max_z)) and voxel-density outlier removal
+    class_table = {0: -1}
+    keep_unlisted = True
+    crop_bounds = None
+    outlier_voxel_size = None
+    outlier_min_points = 2
+
     # By default
     # raw data: "dataset/semantic_raw"
     # downsampled data: "dataset/semantic_downsampled"
@@ -254,14 +527,14 @@ if __name__ == "__main__":
             dense_label_path = os.path.join(raw_dir, file_prefix + ".labels")
             sparse_pcd_path = os.path.join(downsampled_dir, file_prefix + ".pcd")
             sparse_label_path = os.path.join(downsampled_dir, file_prefix + ".labels")
-            down_sample(dense_pcd_path, dense_label_path, sparse_pcd_path, sparse_label_path, voxel_size)
+            down_sample(dense_pcd_path, dense_label_path, sparse_pcd_path, sparse_label_path, voxel_size, sampling_mode, num_points, seed, class_table, keep_unlisted, crop_bounds, outlier_voxel_size, outlier_min_points)
 
             # Convert pcd to las with labels
             convert_pcd_to_las_with_classifications(open3d.io.read_point_cloud(sparse_pcd_path), las_labels_path, sparse_label_path)
         else:
             dense_pcd_path = os.path.join(raw_dir, file_prefix + ".pcd")
             sparse_pcd_path = os.path.join(downsampled_dir, file_prefix + ".pcd")
-            down_sample(dense_pcd_path, None, sparse_pcd_path, None, voxel_size)
+            down_sample(dense_pcd_path, None, sparse_pcd_path, None, voxel_size, sampling_mode, num_points, seed, class_table, keep_unlisted, crop_bounds, outlier_voxel_size, outlier_min_points)
 
             # Convert pcd to las
             convert_pcd_to_las(open3d.io.read_point_cloud(sparse_pcd_path), las_path)
@@ -0,0 +1,462 @@
+"""
+Script Name: Benchmark_ImageDataPrep_AP_1.0.py
+Description: Benchmark image data-prep scripts (downsize, patch manually, patchify, merge yolo classes, yolo to coco) on synthetic datasets.
+Created Date: 2024-04-26
+Author: Ana Petrovic
+Version: 1.0
+Last Modified: 2024-04-26
+Modified by:
+
+Example Usage:
+python Benchmark_ImageDataPrep_AP_1.0.py --path/to/work/dir [--num_images 16] [--width 1980] [--height 2640] [--workers 1,2,4] [--repeats 3] [--min_seconds 1] [--baseline baseline.json] [--save_baseline]
+
+***Note***:
+Synthetic images, masks and YOLO segmentation labels are generated in work dir.
+Every tool is run as separate processes, each worker process gets its own shard of the dataset.
+For every tool and worker count the script measures images/second, tiles/second,
+annotations/second, peak RSS of the biggest worker and bytes written.
+Every configuration is run repeats times and the fastest run is reported (and stored in baseline),
+inside a run every worker repeats its tool until min_seconds pass and reports its fastest pass.
+Time is measured inside every worker around the tool body (imports are loaded before),
+so interpreter start-up is not counted, and a run lasts until its slowest worker is done.
+Tiles count image tiles only, patchify mask tiles are reported as mask_tiles.
+Peak RSS is VmHWM read inside each tool process (Linux only), so it does not include the benchmark itself.
+Results are saved as JSON and compared against baseline JSON, script exits with code 1
+if throughput of any tool drops more than tolerance below baseline.
+Patchify script only patches images with height of at least 2640 and width of at least 1978,
+so keep height >= 2640 and width >= 1978.
+
+***Expected folder structure***:
+.
+├── Benchmark_ImageDataPrep_AP_1.0.py
+├── DataPrep_*.py
+└── work/dir
+    ├── dataset
+    │   ├── images
+    │   ├── masks
+    │   └── labels
+    ├── runs
+    │   └── tool_wN/worker_K
+    └── results.json
+
+Dependencies:
+os, sys, ast, json, time, runpy, importlib, shutil, argparse, statistics, subprocess, platform, cv2, numpy
+"""
+import os
+import sys
+import ast
+import json
+import time
+import runpy
+import importlib
+import shutil
+import argparse
+import statistics
+import subprocess
+import platform
+
+# Folder with scripts that are benchmarked
+SCRIPTS_DIR = os.path.dirname(os.path.realpath(__file__))
+
+# Metric compared against baseline for every tool
+MAIN_METRIC = {
+    "downsize": "images_per_second",
+    "patch_manually": "tiles_per_second",
+    "patchify": "tiles_per_second",
+    "merge_classes": "annotations_per_second",
+    "yolo_to_coco": "annotations_per_second",
+}
+
+# Scripts which are called through worker mode
+WORKER_SCRIPTS = {
+    "patch_manually": "DataPrep_PatchManually_AP_1.0.py",
+    "merge_classes": "DataPrep_MergeClassesYolo_AP_1.0.py",
+}
+
+# Load only imports and functions of a script, scripts run their work at module level
+def load_functions(script_name):
+    script_path = os.path.join(SCRIPTS_DIR, script_name)
+    with open(script_path, "r") as f:
+        tree = ast.parse(f.read(), filename=script_path)
+    tree.body = [node for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom, ast.FunctionDef))]
+    namespace = {}
+    exec(compile(tree, script_path, "exec"), namespace)
+    return namespace
+
+# Worker mode, calls functions of scripts which can not be run directly on given folders
+def run_worker(tool, input_path, output_path):
+    if tool == "patch_manually":
+        patch_image_with_overlaps = load_functions(WORKER_SCRIPTS[tool])["patch_image_with_overlaps"]
+        for file_name in sorted(os.listdir(input_path)):
+
+            # Patch names only hold patch position, so every image gets its own folder
+            image_output_path = os.path.join(output_path, os.path.splitext(file_name)[0])
+            os.makedirs(image_output_path, exist_ok=True)
+            patch_image_with_overlaps(os.path.join(input_path, file_name), 512, 2, image_output_path)
+    elif tool == "merge_classes":
+        merge_classes = load_functions(WORKER_SCRIPTS[tool])["merge_classes"]
+        merge_classes(input_path)
+
+# Read peak RSS (VmHWM) of this process in kB, None if /proc is not available
+def read_peak_rss_kb():
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+# Import modules which a script imports at top level, failures are left to the script itself
+def preload_imports(script_path):
+    with open(script_path, "r") as f:
+        tree = ast.parse(f.read(), filename=script_path)
+    for node in tree.body:
+        names = [alias.name for alias in node.names] if isinstance(node, ast.Import) else [node.module] if isinstance(node, ast.ImportFrom) and node.level == 0 else []
+        for name in names:
+            try:
+                importlib.import_module(name)
+            except ImportError:
+                pass
+
+# Measure mode, runs a script in this process and writes seconds of its fastest run and peak RSS to measure_path.
+# Imports are loaded before the timer starts, so interpreter start-up and imports are not timed.
+# Short tools are run again until min_seconds pass, every tool rewrites the same outputs on each run.
+# Peak RSS has to be read inside the tool process, ru_maxrss of a forked child also counts the parent
+def run_measured(measure_path, min_seconds, script_path, script_args):
+    preload_imports(script_path)
+    if os.path.realpath(script_path) == os.path.realpath(__file__) and script_args[:1] == ["worker"]:
+        preload_imports(os.path.join(SCRIPTS_DIR, WORKER_SCRIPTS[script_args[1]]))
+
+    sys.argv = [script_path] + script_args
+    sys.path.insert(0, os.path.dirname(script_path))
+    pass_seconds = []
+    start = time.perf_counter()
+    while not pass_seconds or time.perf_counter() - start < min_seconds:
+        pass_start = time.perf_counter()
+
+        # Scripts ending with sys.exit(0) finished normally
+        try:
+            runpy.run_path(script_path, run_name="__main__")
+        except SystemExit as exit:
+            if exit.code not in (None, 0):
+                raise
+        pass_seconds.append(time.perf_counter() - pass_start)
+
+    # Fastest pass is the least disturbed by other processes
+    with open(measure_path, "w") as f:
+        json.dump({"seconds": min(pass_seconds), "passes": len(pass_seconds), "peak_rss_kb": read_peak_rss_kb()}, f)
+
+# Generate synthetic images, masks and yolo segmentation labels
+def generate_dataset(dataset_dir, num_images, width, height, num_classes, num_polygons, num_annotations, seed):
+
+    # Imported here only, so measure and worker processes do not carry them in peak RSS
+    import cv2
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    images_dir = os.path.join(dataset_dir, "images")
+    masks_dir = os.path.join(dataset_dir, "masks")
+    labels_dir = os.path.join(dataset_dir, "labels")
+    for folder in (images_dir, masks_dir, labels_dir):
+        os.makedirs(folder, exist_ok=True)
+
+    yy, xx = np.mgrid[0:height, 0:width]
+    for index in range(num_images):
+        name = "image_{:05d}".format(index)
+
+        # Gradient with noise, compresses like a real photo more than pure noise
+        image = np.stack([xx * 255 // width, yy * 255 // height, (xx + yy) * 255 // (width + height)], axis=-1)
+        image = (image + rng.integers(0, 32, size=image.shape)).clip(0, 255).astype(np.uint8)
+
+        # Mask and labels share the same random polygons
+        mask = np.zeros((height, width), dtype=np.uint8)
+        lines = []
+        for _ in range(num_polygons):
+            class_id = int(rng.integers(0, num_classes))
+            center = rng.uniform([0.1, 0.1], [0.9, 0.9])
+            num_vertices = int(rng.integers(4, 12))
+            angles = np.sort(rng.uniform(0, 2 * np.pi, num_vertices))
+            radius = rng.uniform(0.02, 0.1, num_vertices)
+            polygon = (center + np.stack([np.cos(angles), np.sin(angles)], axis=1) * radius[:, None]).clip(0, 1)
+
+            cv2.fillPoly(mask, [(polygon * [width - 1, height - 1]).astype(np.int32)], class_id + 1)
+            lines.append(" ".join([str(class_id)] + ["{:.6f}".format(x) for x in polygon.ravel()]))
+
+        # Labels get more polygons than masks, so label tools run long enough to be measured
+        num_extra = max(num_annotations - num_polygons, 0)
+        extra_classes = rng.integers(0, num_classes, num_extra)
+        extra_polygons = rng.uniform(0, 1, (num_extra, 16))
+        for class_id, polygon in zip(extra_classes, extra_polygons):
+            lines.append(" ".join([str(class_id)] + ["{:.6f}".format(x) for x in polygon]))
+
+        cv2.imwrite(os.path.join(images_dir, name + ".png"), image)
+        cv2.imwrite(os.path.join(masks_dir, name.replace("image_", "mask_") + ".png"), mask)
+        with open(os.path.join(labels_dir, name + ".txt"), "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+    return images_dir, masks_dir, labels_dir
+
+# Hard link file if possible, labels are always copied because merge_classes edits them in place
+def place_file(source, destination, copy=False):
+    if not copy:
+        try:
+            os.link(source, destination)
+            return
+        except OSError:
+            pass
+    shutil.copyfile(source, destination)
+
+# Sum of sizes of all files in folders
+def folder_bytes(folders):
+    total = 0
+    for folder in folders:
+        for root, _, files in os.walk(folder):
+            total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return total
+
+# Count files in folders
+def folder_files(folders):
+    return sum(len(files) for folder in folders for _, _, files in os.walk(folder))
+
+# Prepare worker folder for a tool, return command, working dir, output folders and image tile folders
+def prepare_worker(tool, worker_dir, names, images_dir, masks_dir, labels_dir):
+    input_images = os.path.join(worker_dir, "images")
+    output_dir = os.path.join(worker_dir, "output")
+
+    if tool == "patchify":
+        # Patchify script uses fixed relative paths, so they are created inside worker dir
+        input_images = os.path.join(worker_dir, "path", "to", "images", "folder")
+        input_masks = os.path.join(worker_dir, "path", "to", "masks", "folder")
+        output_images = os.path.join(worker_dir, "path", "to", "output", "folder")
+        output_masks = os.path.join(worker_dir, "path", "to", "labels")
+        for folder in (input_images, input_masks, output_images, output_masks):
+            os.makedirs(folder, exist_ok=True)
+        for name in names:
+            place_file(os.path.join(images_dir, name + ".png"), os.path.join(input_images, name + ".png"))
+            mask_name = name.replace("image_", "mask_") + ".png"
+            place_file(os.path.join(masks_dir, mask_name), os.path.join(input_masks, mask_name))
+        command = [sys.executable, os.path.join(SCRIPTS_DIR, "DataPrep_PatchWithPatchify_AP_1.0.py")]
+        return command, worker_dir, [output_images, output_masks], [output_images]
+
+    if tool == "merge_classes":
+        input_labels = os.path.join(worker_dir, "labels")
+        os.makedirs(input_labels, exist_ok=True)
+        for name in names:
+            place_file(os.path.join(labels_dir, name + ".txt"), os.path.join(input_labels, name + ".txt"), copy=True)
+        command = [sys.executable, os.path.abspath(__file__), "worker", tool, input_labels, input_labels]
+        return command, worker_dir, [input_labels], []
+
+    os.makedirs(input_images, exist_ok=True)
+    os.makedirs(output_dir, exist_ok=True)
+    for name in names:
+        place_file(os.path.join(images_dir, name + ".png"), os.path.join(input_images, name + ".png"))
+
+    if tool == "downsize":
+        command = [sys.executable, os.path.join(SCRIPTS_DIR, "DataPrep_DownsizeImages_AP_1.0.py"), input_images, output_dir]
+    elif tool == "patch_manually":
+        command = [sys.executable, os.path.abspath(__file__), "worker", tool, input_images, output_dir]
+    elif tool == "yolo_to_coco":
+        input_labels = os.path.join(worker_dir, "labels")
+        os.makedirs(input_labels, exist_ok=True)
+        for name in names:
+            place_file(os.path.join(labels_dir, name + ".txt"), os.path.join(input_labels, name + ".txt"), copy=True)
+        command = [sys.executable, os.path.join(SCRIPTS_DIR, "DataPrep_ConvertYoloToCoco_AP_1.0.py"), input_images, output_dir, input_labels, input_labels]
+    else:
+        raise ValueError("Unknown tool: {}".format(tool))
+
+    return command, worker_dir, [output_dir], [output_dir] if tool == "patch_manually" else []
+
+# Run one tool once with given number of workers, return tool seconds, wall seconds, peak RSS per worker, bytes written, image tiles and mask tiles
+def run_tool_once(tool, num_workers, min_seconds, run_dir, names, images_dir, masks_dir, labels_dir):
+    shutil.rmtree(run_dir, ignore_errors=True)
+
+    # Split dataset into one shard per worker
+    workers = []
+    for worker_index in range(num_workers):
+        shard = names[worker_index::num_workers]
+        if not shard:
+            continue
+        worker_dir = os.path.join(run_dir, "worker_{}".format(worker_index))
+        os.makedirs(worker_dir, exist_ok=True)
+        workers.append(prepare_worker(tool, worker_dir, shard, images_dir, masks_dir, labels_dir))
+
+    # Start all workers at once, every worker runs its tool through measure mode
+    start = time.perf_counter()
+    processes = []
+    for command, cwd, _, _ in workers:
+        log = open(os.path.join(cwd, "log.txt"), "w")
+        measured_command = [sys.executable, os.path.abspath(__file__), "measure", os.path.join(cwd, "measure.json"), str(min_seconds)] + command[1:]
+        processes.append((subprocess.Popen(measured_command, cwd=cwd, stdout=log, stderr=subprocess.STDOUT), log))
+    for process, log in processes:
+        process.wait()
+        log.close()
+        if process.returncode != 0:
+            raise RuntimeError("{} failed, see logs in {}".format(tool, run_dir))
+    wall_seconds = time.perf_counter() - start
+
+    # Run ends when the slowest worker finishes its tool body
+    measurements = []
+    for _, cwd, _, _ in workers:
+        with open(os.path.join(cwd, "measure.json"), "r") as f:
+            measurements.append(json.load(f))
+    seconds = max(m["seconds"] for m in measurements)
+    peak_rss_kb = [m["peak_rss_kb"] for m in measurements]
+
+    # Output folders start empty, merge_classes rewrites every label file it is given
+    outputs = [output for _, _, worker_outputs, _ in workers for output in worker_outputs]
+    tile_outputs = [output for _, _, _, worker_tile_outputs in workers for output in worker_tile_outputs]
+    bytes_written = folder_bytes(outputs)
+    num_tiles = folder_files(tile_outputs)
+    num_mask_tiles = folder_files(outputs) - num_tiles if tool == "patchify" else 0
+    return seconds, wall_seconds, peak_rss_kb, bytes_written, num_tiles, num_mask_tiles
+
+# Run one tool repeats times with given number of workers and return measurements of the fastest run
+def benchmark_tool(tool, num_workers, repeats, min_seconds, runs_dir, images_dir, masks_dir, labels_dir):
+    names = sorted(os.path.splitext(f)[0] for f in os.listdir(images_dir))
+    run_dir = os.path.join(runs_dir, "{}_w{}".format(tool, num_workers))
+
+    # Annotations are counted before merge_classes rewrites the labels
+    num_annotations = 0
+    if tool in ("merge_classes", "yolo_to_coco"):
+        for name in names:
+            with open(os.path.join(labels_dir, name + ".txt"), "r") as f:
+                num_annotations += sum(1 for line in f if line.strip())
+
+    runs = [run_tool_once(tool, num_workers, min_seconds, run_dir, names, images_dir, masks_dir, labels_dir) for _ in range(repeats)]
+    seconds_runs = [run[0] for run in runs]
+    seconds = min(seconds_runs)
+    wall_seconds = statistics.median(run[1] for run in runs)
+    peak_rss_kb = [rss for run in runs for rss in run[2] if rss is not None]
+    worker_rss_kb = [sum(rss for rss in run[2] if rss is not None) for run in runs]
+    _, _, _, bytes_written, num_tiles, num_mask_tiles = runs[-1]
+
+    return {
+        "tool": tool,
+        "workers": num_workers,
+        "repeats": repeats,
+        "seconds": seconds,
+        "seconds_runs": seconds_runs,
+        "wall_seconds": wall_seconds,
+        "images": len(names),
+        "tiles": num_tiles,
+        "mask_tiles": num_mask_tiles,
+        "annotations": num_annotations,
+        "images_per_second": len(names) / seconds,
+        "tiles_per_second": num_tiles / seconds,
+        "annotations_per_second": num_annotations / seconds,
+        "peak_rss_mb": max(peak_rss_kb) / 1024 if peak_rss_kb else None,
+        "total_rss_mb": max(worker_rss_kb) / 1024 if peak_rss_kb else None,
+        "bytes_written": bytes_written,
+    }
+
+# Compare results against baseline, return list of regressions
+def compare_to_baseline(results, baseline, tolerance):
+    baseline_results = {(r["tool"], r["workers"]): r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        reference = baseline_results.get((result["tool"], result["workers"]))
+        if reference is None:
+            continue
+        metric = MAIN_METRIC[result["tool"]]
+        ratio = result[metric] / reference[metric] if reference[metric] else 1.0
+        print("{:<15} w={:<3} {:<24} {:10.2f} baseline {:10.2f} ({:+.1%})".format(result["tool"], result["workers"], metric, result[metric], reference[metric], ratio - 1))
+        if ratio < 1 - tolerance:
+            regressions.append((result["tool"], result["workers"], metric, ratio))
+    return regressions
+
+if __name__ == "__main__":
+
+    # Worker and measure modes are used internally by run_tool_once
+    if len(sys.argv) > 1 and sys.argv[1] == "worker":
+        run_worker(sys.argv[2], sys.argv[3], sys.argv[4])
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "measure":
+        run_measured(sys.argv[2], float(sys.argv[3]), sys.argv[4], sys.argv[5:])
+        sys.exit(0)
+
+    # Define parser
+    parser = argparse.ArgumentParser(description='Benchmark image data-prep scripts on synthetic data')
+
+    # Add arguments for folder paths and dataset size
+    parser.add_argument('work_dir', type=str, help='Path to the folder for synthetic data, outputs and results')
+    parser.add_argument('--num_images', type=int, default=16, help='Number of synthetic images')
+    parser.add_argument('--width', type=int, default=1980, help='Width of synthetic images')
+    parser.add_argument('--height', type=int, default=2640, help='Height of synthetic images')
+    parser.add_argument('--num_classes', type=int, default=9, help='Number of classes in masks and labels')
+    parser.add_argument('--num_polygons', type=int, default=20, help='Number of polygons drawn in every mask')
+    parser.add_argument('--num_annotations', type=int, default=20000, help='Number of yolo annotations per image (at least num_polygons)')
+    parser.add_argument('--workers', type=str, default='1,2,4', help='Comma separated worker counts')
+    parser.add_argument('--tools', type=str, default=','.join(MAIN_METRIC), help='Comma separated tools to benchmark')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for synthetic data')
+    parser.add_argument('--results', type=str, default=None, help='Path to results JSON, default work_dir/results.json')
+    parser.add_argument('--baseline', type=str, default=None, help='Path to baseline JSON to compare against')
+    parser.add_argument('--save_baseline', action='store_true', help='Write results to baseline path')
+    parser.add_argument('--repeats', type=int, default=3, help='Runs per tool and worker count, fastest run is reported')
+    parser.add_argument('--min_seconds', type=float, default=1.0, help='Every worker repeats its tool until this much time passes')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Allowed relative throughput drop')
+
+    # Parse command-line arguments
+    args = parser.parse_args()
+
+    dataset_dir = os.path.join(args.work_dir, "dataset")
+    runs_dir = os.path.join(args.work_dir, "runs")
+    results_path = args.results or os.path.join(args.work_dir, "results.json")
+    worker_counts = [int(w) for w in args.workers.split(",")]
+    tools = args.tools.split(",")
+
+    # Generate synthetic data (regenerated every time so runs are comparable)
+    shutil.rmtree(dataset_dir, ignore_errors=True)
+    print("Generating {} images of {}x{}".format(args.num_images, args.width, args.height))
+    images_dir, masks_dir, labels_dir = generate_dataset(dataset_dir, args.num_images, args.width, args.height, args.num_classes, args.num_polygons, args.num_annotations, args.seed)
+
+    results = []
+    for tool in tools:
+        for num_workers in worker_counts:
+            result = benchmark_tool(tool, num_workers, args.repeats, args.min_seconds, runs_dir, images_dir, masks_dir, labels_dir)
+            print("{:<15} w={:<3} {:7.2f}s  img/s {:8.2f}  tiles/s {:8.2f}  ann/s {:10.2f}  peak RSS {:8.1f} MB  written {:12d} B".format(
+                tool, num_workers, result["seconds"], result["images_per_second"], result["tiles_per_second"],
+                result["annotations_per_second"], result["peak_rss_mb"] or 0.0, result["bytes_written"]))
+            results.append(result)
+
+    report = {
+        "config": {
+            "num_images": args.num_images,
+            "width": args.width,
+            "height": args.height,
+            "num_classes": args.num_classes,
+            "num_polygons": args.num_polygons,
+            "num_annotations": args.num_annotations,
+            "seed": args.seed,
+            "repeats": args.repeats,
+            "min_seconds": args.min_seconds,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "results": results,
+    }
+
+    # Save results
+    with open(results_path, "w") as f:
+        json.dump(report, f, indent=4)
+    print("Results written to:", results_path)
+
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=4)
+        print("Baseline written to:", args.baseline)
+    elif args.baseline and os.path.isfile(args.baseline):
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        if baseline["config"] != report["config"]:
+            print("Warning: baseline was made with different config", baseline["config"])
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        if regressions:
+            for tool, num_workers, metric, ratio in regressions:
+                print("Regression: {} with {} workers, {} is {:.1%} of baseline".format(tool, num_workers, metric, ratio))
+            sys.exit(1)
+        print("No regressions against baseline")
@@ -0,0 +1,219 @@
+"""
+Script Name: DataPrep_ConvertMasksToCocoRLE_AP_1.0.py
+Description: Script that converts raster masks (e.g. patches from DataPrep_PatchWithPatchify_AP_1.0.py) to COCO JSON format with compressed RLE segmentations.
+Created Date: 2024-04-26
+Author: Ana Petrovic
+Version: 1.0
+Last Modified: 2024-04-26
+Modified by:
+
+Example Usage:
+python DataPrep_ConvertMasksToCocoRLE_AP_1.0.py --path/to/images/folder --path/to/masks/folder --path/to/json/file [--mode instance|class] [--background_value 0] [--category_offset 1]
+
+***Note***:
+Every mask pixel holds category id + category_offset, pixels equal to background_value are skipped.
+By default background is 0 and category 0 ("e") is stored as 1, category 8 ("flat") as 9.
+For masks which store category ids directly use --category_offset 0 --background_value 255.
+In "class" mode every category present in a mask becomes one annotation,
+in "instance" mode every connected region of a category becomes one annotation.
+Segmentations are stored as compressed RLE strings (same encoding as pycocotools),
+which makes annotation files much smaller and faster to load than polygon float lists.
+Mask named mask_X.png is matched to image_X.png (patchify naming) or to image with the same name.
+
+Dependencies:
+os, json, datetime, cv2, numpy, argparse
+"""
+import os
+import json
+import datetime
+import cv2
+import numpy as np
+import argparse
+
+# Define parser
+parser = argparse.ArgumentParser(description='Parse images, masks and output paths')
+
+# Add arguments for folder paths
+parser.add_argument('images_path', type=str, help='Path to the images folder')
+parser.add_argument('masks_path', type=str, help='Path to the raster masks folder')
+parser.add_argument('output_path', type=str, help='Path to the output path')
+parser.add_argument('--mode', type=str, default='instance', choices=['instance', 'class'], help='One annotation per connected instance or per class')
+parser.add_argument('--background_value', type=int, default=0, help='Mask value that is not annotated')
+parser.add_argument('--category_offset', type=int, default=1, help='Mask value = category id + category offset')
+
+# Parse command-line arguments
+args = parser.parse_args()
+
+# Access the folder paths provided as arguments
+images_path = args.images_path
+masks_path = args.masks_path
+output_path = args.output_path
+mode = args.mode
+background_value = args.background_value
+category_offset = args.category_offset
+
+# Define categories for the COCO dataset, same as in DataPrep_ConvertYoloToCoco_AP_1.0.py
+categories = [
+    {"id": 0, "name": "e"},
+    {"id": 1, "name": "n"},
+    {"id": 2, "name": "ne"},
+    {"id": 3, "name": "nw"},
+    {"id": 4, "name": "s"},
+    {"id": 5, "name": "se"},
+    {"id": 6, "name": "Sw"},
+    {"id": 7, "name": "w"},
+    {"id": 8, "name": "flat"},
+]
+
+# Define COCO dataset dictionary
+coco_dataset = {
+    "info": {
+        "year": 2023,
+        "version": "1.0",
+        "description": "PlanetSoft rooftops segments dataset",
+        "contributor": "Label Studio",
+        "url": "",
+        "date_created": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+        },
+    "images": [],
+    "annotations": [],
+    "categories": categories,
+}
+
+# Compute uncompressed RLE counts of a binary mask in COCO (column-major) order
+def rle_counts(binary_mask):
+    flat = binary_mask.ravel(order='F').astype(np.int8)
+
+    # Positions where value changes, counts always start with the run of zeros
+    change_positions = np.flatnonzero(np.diff(flat)) + 1
+    boundaries = np.concatenate([[0], change_positions, [flat.shape[0]]])
+    counts = np.diff(boundaries)
+    if flat[0] == 1:
+        counts = np.concatenate([[0], counts])
+    return counts
+
+# Compress RLE counts into a COCO string (same encoding as pycocotools maskApi rleToString)
+def rle_to_string(counts):
+    x = counts.astype(np.int64)
+
+    # Store difference to the count two runs back, it is usually small
+    x[3:] -= counts[1:-2]
+
+    # Split every value into 5 bit groups, 6th bit of a char marks that more chars follow
+    shifts = 5 * np.arange(13)
+    groups = (x[:, None] >> shifts) & 0x1f
+    rest = x[:, None] >> (shifts + 5)
+    more = np.where(groups & 0x10, rest != -1, rest != 0)
+
+    # Keep groups up to and including the first one without continuation
+    lengths = np.argmin(more, axis=1) + 1
+    used = np.arange(shifts.shape[0]) < lengths[:, None]
+    chars = (groups | (more << 5)) + 48
+    return chars[used].astype(np.uint8).tobytes().decode('ascii')
+
+# Build COCO RLE segmentation dictionary from columns [left, left + strip width) of a mask,
+# only the strip is scanned, columns outside it are known to be empty
+def encode_rle(strip, left, width):
+    height = strip.shape[0]
+    counts = rle_counts(strip)
+    counts[0] += left * height
+    trailing = (width - left - strip.shape[1]) * height
+    if trailing:
+        # Odd number of runs means the last run is zeros
+        if counts.shape[0] % 2 == 1:
+            counts[-1] += trailing
+        else:
+            counts = np.append(counts, trailing)
+    return {"size": [height, width], "counts": rle_to_string(counts)}
+
+# Return list of (category_id, rle, area, bbox) for every annotation in the mask
+def mask_to_annotations(mask):
+    annotations = []
+    width = mask.shape[1]
+    mask_values = np.unique(mask)
+    mask_values = mask_values[mask_values != background_value]
+
+    for value in mask_values:
+        category_mask = (mask == value).astype(np.uint8)
+        category_id = int(value) - category_offset
+
+        if mode == 'class':
+            # Area and bbox from row and column projections
+            area = int(category_mask.sum())
+            rows = np.flatnonzero(category_mask.any(axis=1))
+            cols = np.flatnonzero(category_mask.any(axis=0))
+            left, top = int(cols[0]), int(rows[0])
+            bbox = [left, top, int(cols[-1] - left + 1), int(rows[-1] - top + 1)]
+            rle = encode_rle(category_mask[:, left:left + bbox[2]], left, width)
+            annotations.append((category_id, rle, area, bbox))
+        else:
+            # Area and bbox of every connected region are returned by OpenCV in one pass,
+            # each region is encoded from its own bbox columns only
+            num_components, components, stats, _ = cv2.connectedComponentsWithStats(category_mask, connectivity=8)
+            for component_id in range(1, num_components):
+                left, top, bbox_width, bbox_height, area = (int(v) for v in stats[component_id])
+                rle = encode_rle(components[:, left:left + bbox_width] == component_id, left, width)
+                annotations.append((category_id, rle, area, [left, top, bbox_width, bbox_height]))
+
+    return annotations
+
+# Find image which belongs to the given mask
+def find_image_name(mask_name):
+    candidates = [mask_name]
+    if mask_name.startswith('mask_'):
+        candidates.insert(0, 'image_' + mask_name[len('mask_'):])
+    for candidate in candidates:
+        if os.path.exists(os.path.join(images_path, candidate)):
+            return candidate
+    return mask_name
+
+# Convert raster masks to COCO JSON with RLE segmentations
+def convert_masks_to_coco_rle(masks_path, output_path):
+    known_category_ids = {category["id"] for category in categories}
+
+    # Background value which is also a mask value of a known category hides that category
+    hidden_category_id = background_value - category_offset
+    if hidden_category_id not in known_category_ids:
+        hidden_category_id = None
+
+    for file_name in sorted(os.listdir(masks_path)):
+        if not file_name.endswith('.png'):
+            continue
+
+        mask = cv2.imread(os.path.join(masks_path, file_name), cv2.IMREAD_GRAYSCALE)
+        height, width = mask.shape
+
+        if hidden_category_id is not None and (mask == background_value).any():
+            print("Warning: background value {} in {} is also category {}, these pixels are not exported (check --category_offset)".format(background_value, file_name, hidden_category_id))
+
+        # Create image dictionary and add it to the COCO dataset
+        image_id = len(coco_dataset["images"])
+        coco_dataset["images"].append({
+                "width": width,
+                "height": height,
+                "id": image_id,
+                "file_name": find_image_name(file_name),
+        })
+
+        for category_id, rle, area, bbox in mask_to_annotations(mask):
+            if category_id not in known_category_ids:
+                print("Mask value {} (category {}) in {} is not a known category, skipped".format(category_id + category_offset, category_id, file_name))
+                continue
+
+            annotations_dict = {
+                "id" : len(coco_dataset["annotations"]),
+                "image_id" : image_id,
+                "category_id" : category_id,
+                "segmentation" : rle,
+                "bbox" : bbox,
+                "ignore" : 0,
+                "iscrowd" : 0,
+                "area" : area
+            }
+            coco_dataset["annotations"].append(annotations_dict)
+
+    # Save JSON
+    with open(os.path.join(output_path, 'masks-rle.json'), 'w') as file:
+        json.dump(coco_dataset, file, separators=(',', ':'))
+
+convert_masks_to_coco_rle(masks_path, output_path)